@@ -2,13 +2,19 @@ import datetime
 import json
 import os
 import re
+import sqlite3
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import timedelta, timezone
 from typing import Dict, List, Optional, Tuple
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import unquote
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 設定參數
 GAS_KEY = os.getenv("GAS_KEY")
@@ -16,6 +22,8 @@ YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
 TG_BOT_TOKEN = os.getenv("TG_BOT_TOKEN_WM")
 TG_CHAT_ID = os.getenv("TG_CHAT_ID_WM_TRASH")
 HEARTBEAT_URL = os.getenv("HEARTBEAT_URL")
+# 跨次執行保留的快取目錄 (GitHub Actions 以 actions/cache 還原)
+CACHE_DIR = os.getenv("YT_CACHE_DIR") or os.path.expanduser("~/.cache/yt_view_count")
 
 SPREADSHEET_IDS = [
     os.environ.get("SPREADSHEET_ID_MUSE", ""),
@@ -26,6 +34,180 @@ TZ_UTC_PLUS_8 = timezone(timedelta(hours=8))
 DEFAULT_FONT_COLOR = "#000000"
 ERROR_FONT_COLOR = "#ff0000"
 DEFAULT_REGION_BLOCK_SIZE = 6
+# 跨次執行的快取超過此秒數未再使用就清掉，避免檔案無限長大
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+# 影片數沒變的播放清單最多沿用這麼久，之後仍完整重抓一次以更新標題。
+# 只比對 itemCount：若同一週內「刪掉一支 (例如 PV) 又新增一集」，影片數不變，
+# 新集數最多會晚這麼久才被算進來 (playlists API 沒有便宜的「最後一支影片」可比對)
+PLAYLIST_STATE_MAX_AGE = 7 * 24 * 60 * 60
+# 追蹤超過 STABLE_AGE、且上次更新時成長不到 STABLE_RATIO 的影片，
+# 在 REFRESH_AGE 內沿用歷史觀看數，不再重新查詢
+VIEW_HISTORY_STABLE_AGE = 14 * 24 * 60 * 60
+VIEW_HISTORY_STABLE_RATIO = 0.01
+VIEW_HISTORY_REFRESH_AGE = 7 * 24 * 60 * 60
+# 同一區塊內同時查詢 YouTube 的作品數上限
+YOUTUBE_MAX_WORKERS = 16
+# 連線池大小需不小於並行數，避免執行緒互搶連線
+HTTP_POOL_MAXSIZE = 32
+# 被 YouTube 限流 (429) 時最多嘗試幾次，以及單次等待上限 (秒)
+RATE_LIMIT_MAX_ATTEMPTS = 5
+RATE_LIMIT_MAX_DELAY = 60
+# 通知類請求 (Telegram / Heartbeat) 的逾時秒數，網路卡住時不拖住整個工作
+NOTIFY_TIMEOUT = 10
+
+
+def create_http_session():
+    """建立共用連線池的 Session，重用 TLS 連線並對暫時性錯誤自動退避重試"""
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.3,
+        # 429 交給 RateLimiter 處理，讓所有執行緒一起退避
+        status_forcelist=[500, 502, 503, 504],
+        # 重試用盡時回傳最後的 response，交由呼叫端照原本邏輯判斷狀態碼
+        raise_on_status=False,
+    )
+    # pool_block 讓同一主機的同時連線數不超過 pool_maxsize，多出的請求排隊等待
+    session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE, pool_block=True, max_retries=retry),
+    )
+    return session
+
+
+HTTP_SESSION = create_http_session()
+
+
+class RateLimiter:
+    """多執行緒共用的退避閘門：任一請求被限流時，所有請求都暫停到指定時間"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def wait(self):
+        with self._lock:
+            delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def defer(self, seconds):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
+class ViewHistory:
+    """以 SQLite 保存每支影片的觀看數歷史，讓變化很小的舊集數不必每次重查"""
+
+    # SQLite 單一語句的參數數量有上限，IN 查詢分批處理
+    QUERY_CHUNK_SIZE = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS views ("
+                "vid TEXT PRIMARY KEY, cnt INTEGER NOT NULL, prev_cnt INTEGER, "
+                "first_seen INTEGER NOT NULL, ts INTEGER NOT NULL)"
+            )
+        return self._conn
+
+    def load_stable_counts(self, video_ids):
+        """回傳可直接沿用的觀看數 { video_id: view_count }"""
+        now = int(time.time())
+        stable_counts = {}
+        try:
+            with self._lock:
+                conn = self._connect()
+                for i in range(0, len(video_ids), self.QUERY_CHUNK_SIZE):
+                    chunk = video_ids[i : i + self.QUERY_CHUNK_SIZE]
+                    rows = conn.execute(
+                        f"SELECT vid, cnt, prev_cnt, first_seen, ts FROM views "
+                        f"WHERE vid IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                    for vid, cnt, prev_cnt, first_seen, ts in rows:
+                        if (
+                            prev_cnt is not None
+                            and now - first_seen >= VIEW_HISTORY_STABLE_AGE
+                            and now - ts < VIEW_HISTORY_REFRESH_AGE
+                            and cnt - prev_cnt < prev_cnt * VIEW_HISTORY_STABLE_RATIO
+                        ):
+                            stable_counts[vid] = cnt
+        except (sqlite3.Error, OSError) as e:
+            print(f"讀取觀看數歷史失敗，改為全部重新查詢: {e}")
+            return {}
+        return stable_counts
+
+    def record(self, view_counts):
+        """寫入本次查到的觀看數，舊值保留到 prev_cnt 供下次判斷成長幅度"""
+        if not view_counts:
+            return
+        now = int(time.time())
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.executemany(
+                    "INSERT INTO views (vid, cnt, prev_cnt, first_seen, ts) VALUES (?, ?, NULL, ?, ?) "
+                    "ON CONFLICT(vid) DO UPDATE SET prev_cnt = views.cnt, cnt = excluded.cnt, ts = excluded.ts",
+                    [(vid, cnt, now, now) for vid, cnt in view_counts.items()],
+                )
+                conn.commit()
+        except (sqlite3.Error, OSError) as e:
+            print(f"寫入觀看數歷史失敗: {e}")
+
+    def prune(self, expire_before):
+        """刪除太久沒更新的影片，避免資料庫無限長大"""
+        if self._conn is None and not os.path.exists(self.path):
+            return
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute("DELETE FROM views WHERE ts < ?", (expire_before,))
+                conn.commit()
+        except (sqlite3.Error, OSError) as e:
+            print(f"整理觀看數歷史失敗: {e}")
+
+
+def utc_now_iso():
+    """目前 UTC 時間，格式與 YouTube API 回傳的時間相同 (ISO 8601，結尾為 Z)，可直接以字串比較先後"""
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_retry_after(response, default):
+    """解析 Retry-After 秒數；沒有或格式不是秒數時使用預設值"""
+    try:
+        delay = float(response.headers.get("Retry-After", default))
+    except (TypeError, ValueError):
+        delay = default
+    return min(max(delay, 0), RATE_LIMIT_MAX_DELAY)
+
+
+def load_json_file(path, default):
+    """讀取快取 JSON；檔案不存在或損毀時回傳預設值"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"讀取快取 {path} 失敗，改用空快取: {e}")
+        return default
+
+
+def save_json_file(path, data):
+    """先寫暫存檔再取代，避免中途失敗留下半份快取"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
 
 
 # ==========================================
@@ -116,9 +298,10 @@ class RegionStats:
 # 1. Google Apps Script API 類別
 # ==========================================
 class AnimeAPI:
-    def __init__(self, script_url, ss_id):
+    def __init__(self, script_url, ss_id, session=None):
         self.script_url = script_url
         self.ss_id = ss_id
+        self.session = session or HTTP_SESSION
 
     def _call(self, action, payload=None):
         payload = payload or {}
@@ -126,10 +309,12 @@ class AnimeAPI:
         payload["ss_id"] = self.ss_id
 
         try:
-            response = requests.post(
+            # 中文保留 UTF-8 原文且不留空白，batch_update 的大型 payload 可明顯變小
+            body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            response = self.session.post(
                 self.script_url,
-                json=payload,
-                headers={"Content-Type": "application/json"},
+                data=body,
+                headers={"Content-Type": "application/json; charset=utf-8"},
             )
             if response.status_code != 200:
                 # 處理 HTTP 錯誤，避免誤把 HTML/轉址頁當成 JSON
@@ -159,8 +344,46 @@ class AnimeAPI:
 
 
 class YouTubeDataProcessor:
-    def __init__(self, api_key):
+    # 集數解析規則，依優先順序逐一嘗試；在類別建立時預先編譯，避免每個標題重複查 re 快取
+    # re.IGNORECASE 讓 EP/ep/Episode/episode 都能抓到
+    EPISODE_PATTERNS = [
+        re.compile(pattern, re.IGNORECASE)
+        for pattern in [
+            # 1. 中文規則 (例如: 第1集, 第 12 話, 第1.5話)
+            r"第\s*(\d+(?:\.\d+)?)\s*[集話]",
+            # 2. 英文規則 (例如: Episode 5, Episode.05)
+            r"Episode\s*[\.]?\s*(\d+(?:\.\d+)?)",
+            # 3. 泰文規則 (例如: ตอนที่ 5)
+            r"ตอนที่\s*(\d+(?:\.\d+)?)",
+            # 4. 越文規則 (例如: Tập 5)
+            r"Tập\s*(\d+(?:\.\d+)?)",
+            # 5. 印尼文規則 (例如: Misi 5)
+            r"Misi\s*(\d+(?:\.\d+)?)",
+            # 6. 馬來文規則 (例如: Episod 5)
+            r"Episod\s*[\.]?\s*(\d+(?:\.\d+)?)",
+            # 0. 簡寫規則 (例如: EP.5, EP 05)
+            r"EP\s*[\.]?\s*(\d+(?:\.\d+)?)",
+            # 0. 方括號規則 (例如: [12], [05]) - 視情況開啟，可能會誤判年份
+            # r'\[(\d+(?:\.\d+)?)\]',
+            # 0. 純井號規則 (例如: #12)
+            r"#\s*(\d+(?:\.\d+)?)",
+        ]
+    ]
+
+    # 只在 query 內找 list 參數；解碼後必須是合法的播放清單 ID 字元
+    PLAYLIST_ID_PATTERN = re.compile(r"[?&]list=([^&#]+)")
+    PLAYLIST_ID_CHARS = re.compile(r"[A-Za-z0-9_-]+")
+
+    # partial response：只要求實際用到的欄位，回應與快取都小得多
+    PLAYLIST_ITEMS_FIELDS = "nextPageToken,items(snippet(title,position,resourceId/videoId))"
+    PLAYLISTS_FIELDS = "items(id,contentDetails/itemCount)"
+    VIDEOS_FIELDS = "items(id,statistics/viewCount,liveStreamingDetails/scheduledStartTime)"
+
+    def __init__(self, api_key, session=None, cache_dir=None):
         self.api_key = api_key
+        self.session = session or HTTP_SESSION
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.rate_limiter = RateLimiter()
         self.quota_exceeded = False
         # 忽略關鍵字清單
         self.ignore_keywords = [
@@ -187,10 +410,38 @@ class YouTubeDataProcessor:
         ]
         # 有例外動畫名稱的關鍵字
         self.ignore_keywords_exceptions = {"CM": ["testCM動畫名稱"]}
+        # 沒有例外的關鍵字合併成單一正規表示式，一次掃描整個標題
+        # 沒有可合併的關鍵字時不建 pattern，避免空字串 pattern 命中所有標題
+        plain_keywords = [kw for kw in self.ignore_keywords if kw not in self.ignore_keywords_exceptions]
+        self.ignore_pattern = re.compile("|".join(map(re.escape, plain_keywords))) if plain_keywords else None
         self.youtube_base_url = "https://www.googleapis.com/youtube/v3"
         # 同一次執行中，播放清單與影片統計都盡量重用快取，節省 API 配額
         self.playlist_cache: Dict[str, object] = {}
         self.video_stats_cache: Dict[str, Optional[int]] = {}
+        # 同一標題在過濾、判斷清單順序、挑首集時都會解析集數，結果依標題快取
+        self.episode_number_cache: Dict[str, object] = {}
+        # 跨次執行保留播放清單每一頁的 ETag，內容沒變時 API 只回 304
+        self.etag_cache_path = os.path.join(self.cache_dir, "etags.json")
+        self.etag_cache: Dict[str, dict] = load_json_file(self.etag_cache_path, {})
+        # 上次完整抓取時的影片數與清單內容；本次影片數相同就跳過分頁抓取
+        self.playlist_state_path = os.path.join(self.cache_dir, "playlist_state.json")
+        self.playlist_state: Dict[str, dict] = load_json_file(self.playlist_state_path, {})
+        self.playlist_item_counts: Dict[str, int] = {}
+        self.view_history = ViewHistory(os.path.join(self.cache_dir, "view_history.sqlite3"))
+        self._playlist_locks: Dict[str, threading.Lock] = {}
+        self._playlist_locks_guard = threading.Lock()
+
+    def _get(self, url, headers=None):
+        """對 YouTube API 發出 GET；遇到 429 依 Retry-After 讓所有執行緒一起退避後重試"""
+        for attempt in range(RATE_LIMIT_MAX_ATTEMPTS):
+            self.rate_limiter.wait()
+            res = self.session.get(url, headers=headers)
+            if res.status_code != 429:
+                return res
+            delay = parse_retry_after(res, 2**attempt)
+            print(f"YouTube API rate limited, retrying in {delay:g}s...")
+            self.rate_limiter.defer(delay)
+        return res
 
     def _check_quota(self, response):
         if response.status_code == 403:
@@ -209,25 +460,54 @@ class YouTubeDataProcessor:
         """從連結中提取 Playlist ID"""
         if not url:
             return None
-        try:
-            query = parse_qs(urlparse(url).query)
-            if "list" in query:
-                return query["list"][0]
-        except Exception:
-            pass
-        return None
+        # 只需要 list 參數，用預先編譯的正規表示式取代完整的 URL 解析；
+        # 與 urlsplit 相同先移除 tab / 換行，並切掉 fragment
+        query = re.sub(r"[\t\r\n]", "", str(url)).split("#", 1)[0]
+        match = self.PLAYLIST_ID_PATTERN.search(query)
+        if not match:
+            return None
+        playlist_id = unquote(match.group(1)).strip()
+        return playlist_id if self.PLAYLIST_ID_CHARS.fullmatch(playlist_id) else None
 
     def get_playlist_items(self, playlist_id, playlist_sequence=0):
         """取得播放清單中的所有影片 ID、標題與在清單中的位置"""
         if self.quota_exceeded:
             return None
 
+        # 同一播放清單可能被多列同時查詢，上鎖讓後到的執行緒直接使用快取
+        with self._get_playlist_lock(playlist_id):
+            items = self._load_playlist_items(playlist_id)
+        if not isinstance(items, list):
+            return items
+        # playlist_sequence 代表同一格有多個播放清單時的原始順序
+        return [{**item, "playlist_sequence": playlist_sequence} for item in items]
+
+    def _get_playlist_lock(self, playlist_id):
+        with self._playlist_locks_guard:
+            return self._playlist_locks.setdefault(playlist_id, threading.Lock())
+
+    def _load_playlist_items(self, playlist_id):
+        """回傳播放清單影片列表；None 代表配額已滿，"REMOVED" 代表清單已移除"""
+        # 等鎖期間其他執行緒可能已遇到配額用盡，此時不再送出請求
+        if self.quota_exceeded:
+            return None
+
         cached = self.playlist_cache.get(playlist_id)
-        if cached == "REMOVED":
-            return "REMOVED"
-        if isinstance(cached, list):
-            # playlist_sequence 代表同一格有多個播放清單時的原始順序
-            return [{**item, "playlist_sequence": playlist_sequence} for item in cached]
+        if cached == "REMOVED" or isinstance(cached, list):
+            return cached
+
+        item_count = self.playlist_item_counts.get(playlist_id)
+        state = self.playlist_state.get(playlist_id)
+        if (
+            item_count is not None
+            and state
+            and state.get("count") == item_count
+            and state.get("ts", 0) >= int(time.time()) - PLAYLIST_STATE_MAX_AGE
+        ):
+            # 影片數與上次相同，沿用上次的清單內容，省下整份分頁抓取
+            items = state["items"]
+            self.playlist_cache[playlist_id] = items
+            return items
 
         items = []
         next_page_token = ""
@@ -236,23 +516,38 @@ class YouTubeDataProcessor:
             url = (
                 f"{self.youtube_base_url}/playlistItems?part=snippet&maxResults=50"
                 f"&playlistId={playlist_id}&key={self.api_key}&hl=zh-Hant"
+                f"&fields={self.PLAYLIST_ITEMS_FIELDS}"
             )
             if next_page_token:
                 url += f"&pageToken={next_page_token}"
 
-            res = requests.get(url)
+            # ETag 以播放清單 + 分頁為 key，URL 內含 API key 不適合直接當 key
+            etag_key = f"playlistItems:{playlist_id}:{next_page_token}"
+            cached_page = self.etag_cache.get(etag_key)
+            headers = {"If-None-Match": cached_page["etag"]} if cached_page else None
+
+            res = self._get(url, headers=headers)
             if self._check_quota(res):
                 return None
             if res.status_code == 404:
                 # 404 視為播放清單已移除，快取結果避免重複打 API
                 self.playlist_cache[playlist_id] = "REMOVED"
+                self.etag_cache.pop(etag_key, None)
                 return "REMOVED"
-            if res.status_code != 200:
+            if res.status_code == 304 and cached_page:
+                # 內容與上次相同，直接沿用上次存下的分頁資料
+                data = cached_page["data"]
+                cached_page["ts"] = int(time.time())
+            elif res.status_code != 200:
                 print(f"Error fetching playlist {playlist_id}: {res.status_code}")
                 self.playlist_cache[playlist_id] = []
                 return []
+            else:
+                data = res.json()
+                etag = res.headers.get("ETag")
+                if etag:
+                    self.etag_cache[etag_key] = {"etag": etag, "data": data, "ts": int(time.time())}
 
-            data = res.json()
             for item in data.get("items", []):
                 snippet = item.get("snippet", {})
                 vid = snippet.get("resourceId", {}).get("videoId")
@@ -271,10 +566,56 @@ class YouTubeDataProcessor:
                 break
 
         self.playlist_cache[playlist_id] = items
-        return [{**item, "playlist_sequence": playlist_sequence} for item in items]
+        if item_count is not None:
+            self.playlist_state[playlist_id] = {"count": item_count, "items": items, "ts": int(time.time())}
+        return items
+
+    def prefetch_playlist_item_counts(self, playlist_ids):
+        """批量查詢播放清單目前的影片數 (每 50 個清單只花 1 單位配額)"""
+        pending_ids = [
+            playlist_id
+            for playlist_id in dict.fromkeys(playlist_ids)
+            if playlist_id not in self.playlist_item_counts and playlist_id not in self.playlist_cache
+        ]
+        for i in range(0, len(pending_ids), 50):
+            if self.quota_exceeded:
+                return
+            batch = pending_ids[i : i + 50]
+            url = (
+                f"{self.youtube_base_url}/playlists?part=contentDetails&maxResults=50"
+                f"&id={','.join(batch)}&key={self.api_key}&fields={self.PLAYLISTS_FIELDS}"
+            )
+            res = self._get(url)
+            if self._check_quota(res):
+                return
+            if res.status_code != 200:
+                # 查不到影片數只是無法跳過抓取，不影響後續流程
+                print(f"Error fetching playlist item counts: {res.status_code}")
+                continue
+            for item in res.json().get("items", []):
+                item_count = item.get("contentDetails", {}).get("itemCount")
+                if item_count is not None:
+                    self.playlist_item_counts[item["id"]] = int(item_count)
+
+    def save_caches(self):
+        """把跨次執行的快取寫回磁碟，順便清掉太久沒用到的項目"""
+        expire_before = int(time.time()) - CACHE_MAX_AGE
+        self.etag_cache = {key: entry for key, entry in self.etag_cache.items() if entry.get("ts", 0) >= expire_before}
+        self.playlist_state = {
+            playlist_id: state for playlist_id, state in self.playlist_state.items() if state.get("ts", 0) >= expire_before
+        }
+        for path, data in ((self.etag_cache_path, self.etag_cache), (self.playlist_state_path, self.playlist_state)):
+            try:
+                save_json_file(path, data)
+            except OSError as e:
+                print(f"寫入快取 {path} 失敗: {e}")
+        self.view_history.prune(expire_before)
 
-    def get_video_stats(self, video_ids):
-        """批量取得影片統計資料 (ViewCount)，並過濾尚未首播的影片"""
+    def get_video_stats(self, video_ids, now_iso=None):
+        """
+        批量取得影片統計資料 (ViewCount)，並過濾尚未首播的影片。
+        now_iso 可由呼叫端傳入 utc_now_iso() 的結果，讓多次呼叫共用同一個判斷基準。
+        """
         if self.quota_exceeded or not video_ids:
             return {}
 
@@ -287,101 +628,95 @@ class YouTubeDataProcessor:
             else:
                 pending_ids.append(vid)
 
-        now_utc = datetime.datetime.now(datetime.timezone.utc)
-        # 每次最多 50 筆
-        for i in range(0, len(pending_ids), 50):
-            batch = pending_ids[i : i + 50]
-            ids_str = ",".join(batch)
-            url = (
-                f"{self.youtube_base_url}/videos?part=statistics,liveStreamingDetails"
-                f"&id={ids_str}&key={self.api_key}&hl=zh-Hant"
-            )
-            res = requests.get(url)
-            if self._check_quota(res):
-                return stats_map
-            if res.status_code != 200:
-                print(f"Error fetching video stats: {res.status_code}")
-                continue
-
-            seen_ids = set()
-            for item in res.json().get("items", []):
-                vid = item.get("id")
-                seen_ids.add(vid)
-
-                live_details = item.get("liveStreamingDetails")
-                if live_details and live_details.get("scheduledStartTime"):
-                    try:
-                        # 如果是未來的首播，先標記成 None，避免提前算進觀看數
-                        dt_start = datetime.datetime.fromisoformat(
-                            live_details["scheduledStartTime"].replace("Z", "+00:00")
-                        )
-                        if dt_start > now_utc:
-                            self.video_stats_cache[vid] = None
-                            stats_map[vid] = None
-                            continue
-                    except ValueError:
-                        pass
-
-                view_count = item.get("statistics", {}).get("viewCount")
-                normalized = int(view_count) if view_count else None
-                self.video_stats_cache[vid] = normalized
-                stats_map[vid] = normalized
-
-            for missing_vid in batch:
-                if missing_vid not in seen_ids:
-                    self.video_stats_cache[missing_vid] = None
+        # 舊集數觀看數幾乎不再變動時直接沿用歷史紀錄，節省配額
+        stable_counts = self.view_history.load_stable_counts(pending_ids) if pending_ids else {}
+        if stable_counts:
+            self.video_stats_cache.update(stable_counts)
+            stats_map.update(stable_counts)
+            pending_ids = [vid for vid in pending_ids if vid not in stable_counts]
+
+        now_iso = now_iso or utc_now_iso()
+        # 每次最多 50 筆，多個批次並行查詢，結果統一寫進 video_stats_cache
+        batches = [pending_ids[i : i + 50] for i in range(0, len(pending_ids), 50)]
+        with ThreadPoolExecutor(max_workers=YOUTUBE_MAX_WORKERS) as executor:
+            list(executor.map(lambda batch: self._fetch_video_stats_batch(batch, now_iso), batches))
+        # 尚未首播 / 已刪除的影片沒有觀看數，不寫入歷史
+        self.view_history.record(
+            {vid: self.video_stats_cache[vid] for vid in pending_ids if self.video_stats_cache.get(vid) is not None}
+        )
+        if self.quota_exceeded:
+            return stats_map
 
         for vid in video_ids:
             if vid not in stats_map and vid in self.video_stats_cache:
                 stats_map[vid] = self.video_stats_cache[vid]
         return stats_map
 
+    def _fetch_video_stats_batch(self, batch, now_iso):
+        """查詢一批 (最多 50 筆) 影片的觀看數並寫入快取"""
+        if self.quota_exceeded:
+            return
+
+        ids_str = ",".join(batch)
+        url = (
+            f"{self.youtube_base_url}/videos?part=statistics,liveStreamingDetails"
+            f"&id={ids_str}&key={self.api_key}&hl=zh-Hant&fields={self.VIDEOS_FIELDS}"
+        )
+        res = self._get(url)
+        if self._check_quota(res):
+            return
+        if res.status_code != 200:
+            print(f"Error fetching video stats: {res.status_code}")
+            return
+
+        seen_ids = set()
+        for item in res.json().get("items", []):
+            vid = item.get("id")
+            seen_ids.add(vid)
+
+            scheduled_start = (item.get("liveStreamingDetails") or {}).get("scheduledStartTime")
+            if scheduled_start and scheduled_start > now_iso:
+                # 如果是未來的首播，先標記成 None，避免提前算進觀看數
+                self.video_stats_cache[vid] = None
+                continue
+
+            view_count = item.get("statistics", {}).get("viewCount")
+            self.video_stats_cache[vid] = int(view_count) if view_count else None
+
+        for missing_vid in batch:
+            if missing_vid not in seen_ids:
+                self.video_stats_cache[missing_vid] = None
+
     def parse_episode_number(self, title):
         """
         從標題解析集數
         回傳: int 或 float (不減 1，直接回傳原始數值)
         """
+        if title in self.episode_number_cache:
+            return self.episode_number_cache[title]
 
-        patterns = [
-            # 1. 中文規則 (例如: 第1集, 第 12 話, 第1.5話)
-            r"第\s*(\d+(?:\.\d+)?)\s*[集話]",
-            # 2. 英文規則 (例如: Episode 5, Episode.05)
-            r"Episode\s*[\.]?\s*(\d+(?:\.\d+)?)",
-            # 3. 泰文規則 (例如: ตอนที่ 5)
-            r"ตอนที่\s*(\d+(?:\.\d+)?)",
-            # 4. 越文規則 (例如: Tập 5)
-            r"Tập\s*(\d+(?:\.\d+)?)",
-            # 5. 印尼文規則 (例如: Misi 5)
-            r"Misi\s*(\d+(?:\.\d+)?)",
-            # 6. 馬來文規則 (例如: Episod 5)
-            r"Episod\s*[\.]?\s*(\d+(?:\.\d+)?)",
-            # 0. 簡寫規則 (例如: EP.5, EP 05)
-            r"EP\s*[\.]?\s*(\d+(?:\.\d+)?)",
-            # 0. 方括號規則 (例如: [12], [05]) - 視情況開啟，可能會誤判年份
-            # r'\[(\d+(?:\.\d+)?)\]',
-            # 0. 純井號規則 (例如: #12)
-            r'#\s*(\d+(?:\.\d+)?)',
-        ]
-
-        for pattern in patterns:
-            # re.IGNORECASE 讓 EP/ep/Episode/episode 都能抓到
-            match = re.search(pattern, title, re.IGNORECASE)
+        episode_number = None
+        for pattern in self.EPISODE_PATTERNS:
+            match = pattern.search(title)
             if not match:
                 continue
             try:
                 num = float(match.group(1))
-                return int(num) if num.is_integer() else num
             except Exception:
                 continue
-        return None
+            episode_number = int(num) if num.is_integer() else num
+            break
+
+        self.episode_number_cache[title] = episode_number
+        return episode_number
 
     def is_ignored_keyword(self, title):
         """檢查是否包含忽略關鍵字"""
-        for kw in self.ignore_keywords:
-            if kw in self.ignore_keywords_exceptions:
-                if any(exc in title for exc in self.ignore_keywords_exceptions[kw]):
-                    continue
-            if kw in title:
+        if self.ignore_pattern and self.ignore_pattern.search(title):
+            return True
+        # 有例外的關鍵字另外檢查，標題命中例外名稱時不視為忽略
+        for kw, exceptions in self.ignore_keywords_exceptions.items():
+            if kw in title and not any(exc in title for exc in exceptions):
                 return True
         return False
 
@@ -434,8 +769,9 @@ class YouTubeDataProcessor:
         rule.match_keywords = [text]
         return rule
 
-    def should_include_video(self, title, rule):
+    def build_video_filter(self, rule):
         """
+        依 OFFSET 規則建立判斷函式，規則欄位先取成區域變數，逐支影片判斷時不必重複讀取。
         規則套用順序固定為：
         1. 結構性忽略詞
         2. exclude
@@ -443,35 +779,44 @@ class YouTubeDataProcessor:
         4. match
         5. offset
         """
-        if self.is_ignored_keyword(title):
-            return False
-
-        if rule.exclude_keywords and any(keyword in title for keyword in rule.exclude_keywords):
-            return False
-
-        if rule.include_keywords and not any(keyword in title for keyword in rule.include_keywords):
-            return False
+        is_ignored_keyword = self.is_ignored_keyword
+        parse_episode_number = self.parse_episode_number
+        exclude_keywords = rule.exclude_keywords
+        include_keywords = rule.include_keywords
+        match_keywords = rule.match_keywords
+        offset_range = rule.offset_range
+
+        def include_video(title):
+            if is_ignored_keyword(title):
+                return False
 
-        # match 陣列採 AND：所有關鍵詞都必須命中
-        if rule.match_keywords and not all(keyword in title for keyword in rule.match_keywords):
-            return False
+            if exclude_keywords and any(keyword in title for keyword in exclude_keywords):
+                return False
 
-        if rule.offset_range is not None:
-            ep_idx = self.parse_episode_number(title)
-            if ep_idx is None:
+            if include_keywords and not any(keyword in title for keyword in include_keywords):
                 return False
-            start, end = rule.offset_range
-            if not (start <= ep_idx <= end):
+
+            # match 陣列採 AND：所有關鍵詞都必須命中
+            if match_keywords and not all(keyword in title for keyword in match_keywords):
                 return False
 
-        return True
+            if offset_range is not None:
+                ep_idx = parse_episode_number(title)
+                if ep_idx is None or not (offset_range[0] <= ep_idx <= offset_range[1]):
+                    return False
 
-    def process_region(self, region_data, rule):
-        """處理單一作品在單一國家區塊內的觀看量計算"""
+            return True
+
+        return include_video
+
+    def collect_region_videos(self, region_data, rule):
+        """
+        讀取單一作品在單一國家區塊內的播放清單，回傳通過規則過濾且去重後的影片。
+        回傳 None 代表沒有有效連結或配額已滿，應跳過此區塊。
+        """
         if self.quota_exceeded:
             return None
 
-        result = RegionStats()
         if not region_data.link_urls:
             return None
 
@@ -494,26 +839,22 @@ class YouTubeDataProcessor:
         if not has_valid_playlist:
             return None
         if not all_items:
-            return result
+            return []
 
-        valid_videos = []
+        # 先依 video id 去重複 (保留第一次出現者)；同一影片標題相同，過濾結果不受影響
+        unique_items = {}
         for item in all_items:
-            if self.should_include_video(item["title"], rule):
-                valid_videos.append(item)
+            unique_items.setdefault(item["id"], item)
+
+        include_video = self.build_video_filter(rule)
+        return [item for item in unique_items.values() if include_video(item["title"])]
 
+    def summarize_region_videos(self, valid_videos, rule):
+        """依已過濾的影片取得觀看數，計算總量、平均與首集觀看"""
+        result = RegionStats()
         if not valid_videos:
             return result
 
-        # 去重複影片（依 video id）
-        deduped_videos = []
-        seen_ids = set()
-        for video in valid_videos:
-            if video["id"] in seen_ids:
-                continue
-            seen_ids.add(video["id"])
-            deduped_videos.append(video)
-        valid_videos = deduped_videos
-
         stats = self.get_video_stats([video["id"] for video in valid_videos])
         # 過濾不存在 / private / deleted 影片
         valid_videos = [video for video in valid_videos if video["id"] in stats]
@@ -534,19 +875,10 @@ class YouTubeDataProcessor:
         # 首集判定優先看最小集數，完全無法解析時才回退到播放清單順序
         first_video = self._select_first_video(valid_videos, playlist_orders, playlist_max_positions)
 
-        # 計算總量與平均
-        total_views = 0
-        valid_view_count = 0
-        has_any_view_data = False
-        for video in valid_videos:
-            views = stats.get(video["id"])
-            if views is None:
-                continue
-            has_any_view_data = True
-            total_views += views
-            valid_view_count += 1
+        # 計算總量與平均 (只取有觀看數的影片，加總交給內建 sum)
+        view_counts = [views for views in (stats.get(video["id"]) for video in valid_videos) if views is not None]
 
-        if not has_any_view_data:
+        if not view_counts:
             result.valid_count = len(valid_videos)
             if first_video is not None:
                 # 全部影片都沒可用觀看數時，首集仍盡量反映該影片是否為會員限定
@@ -554,8 +886,9 @@ class YouTubeDataProcessor:
                 result.first = first_views if first_views is not None else "---"
             return result
 
+        total_views = sum(view_counts)
         result.total = total_views
-        result.avg = int(total_views / valid_view_count) if valid_view_count > 0 else 0
+        result.avg = total_views // len(view_counts)
         result.valid_count = len(valid_videos)
         if first_video is not None:
             first_views = stats.get(first_video["id"])
@@ -619,41 +952,38 @@ class YouTubeDataProcessor:
                 return playlist_max_positions.get(playlist_id, position) - position
             return position
 
+        # 以 (集數, 正規化位置, 影片) tuple 標註，不必為每支影片複製一份 dict
         annotated = []
         has_episode_number = False
         for video in videos:
             ep_idx = self.parse_episode_number(video["title"])
             if ep_idx is not None:
                 has_episode_number = True
-            annotated.append(
-                {
-                    **video,
-                    "episode_number": ep_idx,
-                    "normalized_position": normalized_position(video),
-                }
-            )
+            annotated.append((ep_idx, normalized_position(video), video))
 
         if has_episode_number:
             # 優先取最小集數；同集數時，再用正規化後的清單順序打破平手
-            annotated.sort(
+            first = min(
+                annotated,
                 key=lambda item: (
-                    item["episode_number"] if item["episode_number"] is not None else float("inf"),
-                    item["normalized_position"],
-                    item.get("playlist_sequence", 0),
-                    item.get("position", 0),
-                )
+                    item[0] if item[0] is not None else float("inf"),
+                    item[1],
+                    item[2].get("playlist_sequence", 0),
+                    item[2].get("position", 0),
+                ),
             )
         else:
             # 若完全抓不到集數，只能退回到播放清單順序
-            annotated.sort(
+            first = min(
+                annotated,
                 key=lambda item: (
-                    item["normalized_position"],
-                    item.get("playlist_sequence", 0),
-                    item.get("position", 0),
-                )
+                    item[1],
+                    item[2].get("playlist_sequence", 0),
+                    item[2].get("position", 0),
+                ),
             )
 
-        return annotated[0] if annotated else None
+        return first[2]
 
 
 # ==========================================
@@ -877,9 +1207,22 @@ def finalize_row_updates(row_payloads):
 def calculate_sheet_updates(sheet_model, processor):
     """計算單張工作表所有區塊的更新結果"""
     row_payloads = init_row_updates(sheet_model.rows)
-    row_max_ep_map = {}
-    global_avg_sum_map = {}  # 用於計算綜合排名的累加器 { row_idx: total_sum_avg }
-    row_has_any_links = {}
+    row_max_ep_map = defaultdict(int)
+    global_avg_sum_map = defaultdict(int)  # 用於計算綜合排名的累加器 { row_idx: total_sum_avg }
+    rows_with_links = set()
+    # 首播判斷基準整張表共用一次，不必每次查觀看數都重取時間
+    now_iso = utc_now_iso()
+
+    # 先一次查好本表所有播放清單的影片數，沒變動的清單就不必逐頁重抓
+    processor.prefetch_playlist_item_counts(
+        [
+            playlist_id
+            for row in sheet_model.rows
+            for region_data in row.regions.values()
+            for playlist_id in map(processor.get_playlist_id, region_data.link_urls)
+            if playlist_id
+        ]
+    )
 
     # 遍歷區域
     for region in sheet_model.regions:
@@ -887,10 +1230,9 @@ def calculate_sheet_updates(sheet_model, processor):
         region_results = []
 
         # --- 第一階段：讀取該區域所有影片數據 ---
+        # 先在主執行緒解析各列 OFFSET 規則，YouTube 查詢則交給執行緒池並行處理
+        region_tasks = []
         for row in sheet_model.rows:
-            if processor.quota_exceeded:
-                return []
-
             region_data = row.regions[region.name]
             row_payload = row_payloads[row.row_num]
             rule = processor.parse_offset_rule(region_data.offset_raw)
@@ -902,27 +1244,58 @@ def calculate_sheet_updates(sheet_model, processor):
                     region_data.offset_cell,
                     ERROR_FONT_COLOR if rule.invalid_json else DEFAULT_FONT_COLOR,
                 )
+            region_tasks.append((row, region_data, rule))
+
+        if processor.quota_exceeded:
+            return []
+
+        with ThreadPoolExecutor(max_workers=YOUTUBE_MAX_WORKERS) as executor:
+            futures = {
+                row.row_num: executor.submit(processor.collect_region_videos, region_data, rule)
+                for row, region_data, rule in region_tasks
+                if region_data.link_urls
+            }
+            videos_by_row = {row_num: future.result() for row_num, future in futures.items()}
+
+        # 整個區塊的影片 ID 合併後再批量查觀看數，每次請求都盡量塞滿 50 筆
+        processor.get_video_stats(
+            list(dict.fromkeys(video["id"] for videos in videos_by_row.values() if videos for video in videos)),
+            now_iso=now_iso,
+        )
+        if processor.quota_exceeded:
+            return []
+
+        # 觀看數已在快取中，逐列彙總時不會再打 API
+        rules_by_row = {row.row_num: rule for row, _, rule in region_tasks}
+        stats_by_row = {
+            row_num: None if videos is None else processor.summarize_region_videos(videos, rules_by_row[row_num])
+            for row_num, videos in videos_by_row.items()
+        }
+        if processor.quota_exceeded:
+            return []
 
+        # 依原本列順序輸出進度並累加統計，避免多執行緒打亂 log
+        for row, region_data, rule in region_tasks:
+            row_payload = row_payloads[row.row_num]
             stats = None
             if region_data.link_urls:
-                row_has_any_links[row.row_num] = True
+                rows_with_links.add(row.row_num)
                 row_payload["_has_links"] = True
                 display_name = row.anime_name.split("\n")[0]
-                print(f"  > 處理: {display_name} ...", end=" ", flush=True)
+                message = f"  > 處理: {display_name} ..."
                 if rule.invalid_json:
-                    print("OFFSET JSON 格式錯誤，改以預設過濾規則繼續。", end=" ", flush=True)
+                    message += " OFFSET JSON 格式錯誤，改以預設過濾規則繼續。"
 
-                stats = processor.process_region(region_data, rule)
+                stats = stats_by_row[row.row_num]
                 if stats is None:
-                    print("跳過 (無有效連結/配額滿/API錯誤)")
+                    print(f"{message} 跳過 (無有效連結/配額滿/API錯誤)")
                 else:
-                    print(f"總={stats.total}, 均={stats.avg}, 首={stats.first}, 集={stats.valid_count}")
+                    print(f"{message} 總={stats.total}, 均={stats.avg}, 首={stats.first}, 集={stats.valid_count}")
                     # 累加平均流量至全域 Map，之後拿來算綜合排名
                     if isinstance(stats.avg, int):
-                        global_avg_sum_map[row.row_num] = global_avg_sum_map.get(row.row_num, 0) + stats.avg
+                        global_avg_sum_map[row.row_num] += stats.avg
                     # 總集數取同一列所有區塊裡最大的 valid_count
-                    if stats.valid_count > row_max_ep_map.get(row.row_num, 0):
-                        row_max_ep_map[row.row_num] = stats.valid_count
+                    row_max_ep_map[row.row_num] = max(row_max_ep_map[row.row_num], stats.valid_count)
             elif rule.invalid_json:
                 print(f"  > {row.anime_name.split('\n')[0]} 的 {region.name} OFFSET JSON 格式錯誤，已標紅。")
 
@@ -962,11 +1335,12 @@ def calculate_sheet_updates(sheet_model, processor):
         for row in sheet_model.rows:
             row_payload = row_payloads[row.row_num]
             # 先更新總集數
-            if row.row_num in row_max_ep_map and row_max_ep_map[row.row_num] > 0:
-                queue_value_update(row_payload, row.ep_count_cell, row_max_ep_map[row.row_num])
+            max_ep = row_max_ep_map.get(row.row_num, 0)
+            if max_ep > 0:
+                queue_value_update(row_payload, row.ep_count_cell, max_ep)
 
             # 只有該列至少有一個有效區塊連結時，才寫綜合排名
-            if row.comp_rank_cell and row_has_any_links.get(row.row_num):
+            if row.comp_rank_cell and row.row_num in rows_with_links:
                 queue_value_update(row_payload, row.comp_rank_cell, global_rank_map.get(row.row_num, ""))
 
     return finalize_row_updates(row_payloads)
@@ -988,7 +1362,7 @@ def send_telegram_error(error_msg):
             "chat_id": TG_CHAT_ID,
             "text": f"[日本動畫 Youtube亞洲新番觀看量]\n發生錯誤:\n\n{error_msg}",
         }
-        requests.post(url, json=payload)
+        HTTP_SESSION.post(url, json=payload, timeout=NOTIFY_TIMEOUT)
         print("已發送錯誤通知至 Telegram")
     except Exception as e:
         print(f"發送 Telegram 失敗: {e}")
@@ -1110,21 +1484,20 @@ def main():
         # 捕捉所有執行途中的報錯，傳到 TG
         global_error_occurred = True
 
-        import sys
-        import traceback
-
         error_class = e.__class__.__name__
         detail = e.args[0] if e.args else str(e)
-        # 取得詳細錯誤訊息
-        _, _, tb = sys.exc_info()
-        last_call_stack = traceback.extract_tb(tb)[-1]
-        file_name = last_call_stack[0]
-        line_num = last_call_stack[1]
-        func_name = last_call_stack[2]
-        err_msg = f'File "{file_name}", line {line_num}, in {func_name}: [{error_class}] {detail}'
+        # 只需要最內層的 frame，直接沿著 traceback 走到底，不必建出整串 FrameSummary
+        tb = e.__traceback__
+        while tb.tb_next:
+            tb = tb.tb_next
+        code = tb.tb_frame.f_code
+        err_msg = f'File "{code.co_filename}", line {tb.tb_lineno}, in {code.co_name}: [{error_class}] {detail}'
         print(f"\n❌ 發生嚴重錯誤: {err_msg}")
         send_telegram_error(err_msg)
 
+    # 不論成功與否都保存快取，下次執行可沿用已取得的 ETag
+    yt_processor.save_caches()
+
     if not global_error_occurred:
         print("\n✅ 所有任務執行完成，且無錯誤。")
         try:
@@ -1147,7 +1520,7 @@ def main():
             try:
                 # 發送 Heartbeat
                 print("正在發送 Heartbeat...")
-                requests.get(HEARTBEAT_URL)
+                HTTP_SESSION.get(HEARTBEAT_URL, timeout=NOTIFY_TIMEOUT)
                 print("Heartbeat 發送成功")
             except Exception as e:
                 print(f"Heartbeat 發送失敗: {e}")